@@ -1,46 +1,46 @@
 #!/usr/bin/env python
 import time
 
-nums = range(1000)
+nums = (None,) * 1000
 
 
-def a():
-    stop = time.time() + 0.1
-    while stop > time.time():
-        for i in nums:
-            i = i + 1
+def a(now=time.perf_counter_ns):
+    stop = now() + 100_000_000
+    while now() < stop:
+        for _ in nums:
+            pass
 
 
-def b(i):
+def b(i, now=time.perf_counter_ns):
     if i == 1:
-        stop = time.time() + 0.2
-        while stop > time.time():
-            for i in nums:
-                i = i + 1
+        stop = now() + 200_000_000
+        while now() < stop:
+            for _ in nums:
+                pass
         a()
     elif i == 2:
-        stop = time.time() + 0.2
-        while stop > time.time():
-            for i in nums:
-                i = i + 1
+        stop = now() + 200_000_000
+        while now() < stop:
+            for _ in nums:
+                pass
         b(1)
     else:
-        stop = time.time() + 0.3
-        while stop > time.time():
-            for i in nums:
-                i = i + 1
+        stop = now() + 300_000_000
+        while now() < stop:
+            for _ in nums:
+                pass
 
 
-def c():
+def c(now=time.perf_counter_ns):
     a()
-    stop = time.time() + 0.5
-    while stop > time.time():
-        for i in nums:
-            i = i + 1
+    stop = now() + 500_000_000
+    while now() < stop:
+        for _ in nums:
+            pass
     b(2)
 
-
-c()
-b(0)
-b(1)
-b(2)
+if __name__ == "__main__":
+    c()
+    b(0)
+    b(1)
+    b(2)
@@ -1,10 +1,9 @@
 from __future__ import annotations
 
-import hashlib
+import heapq
 import io
 import locale
 import marshal
-import multiprocessing
 import os
 import pstats
 import re
@@ -15,15 +14,16 @@ import tempfile
 import threading
 import time
 import statistics
+from array import array
 from collections import Counter, defaultdict
-from dataclasses import astuple, dataclass, field
+from dataclasses import dataclass, field
 from datetime import timedelta
 from functools import cached_property
-from typing import Iterable, List, Optional, TypeVar, Union
+from itertools import islice
+from typing import Iterable, Iterator, Optional, TypeVar, Union
 
 import click
 import clickdc
-from graphviz import Digraph
 from tabulate import tabulate
 
 from . import color
@@ -40,13 +40,8 @@ from .compare import CompareArgs, compare_cmd
 T = TypeVar("T")
 V = TypeVar("V")
 
-
-def md5sum(data: str) -> str:
-    return hashlib.md5(data.encode("utf-8")).hexdigest()
-
-
-def clamp(n: int, minn: int, maxn: int) -> int:
-    return max(min(maxn, n), minn)
+# Dataclasses instantiated per record use __slots__ where Python supports it.
+DATACLASS_SLOTS: dict[str, bool] = {"slots": True} if sys.version_info >= (3, 10) else {}
 
 
 def dots_trim(v: str, width: int = 50) -> str:
@@ -54,18 +49,15 @@ def dots_trim(v: str, width: int = 50) -> str:
     return v if len(v) <= width else (v[: width - 2] + "..")
 
 
-def file_newer(a: str, b: str) -> bool:
-    return (
-        os.path.exists(a)
-        and os.path.exists(b)
-        and os.path.getctime(a) > os.path.getctime(b)
-    )
+def dot_quote(txt: str) -> str:
+    """Quote a string to be used as an ID in DOT language"""
+    return '"' + txt.replace("\\", "\\\\").replace('"', '\\"') + '"'
 
 
 def maybe_take_n(generator: Iterable[T], n: Optional[int]) -> Iterable[T]:
     """If n is ok, then take up to n elements"""
     if n and n > 0:
-        return (a for _, a in zip(range(n), generator))
+        return islice(generator, n)
     else:
         return generator
 
@@ -81,29 +73,6 @@ def us2s(us: int) -> float:
     return us / 1000000
 
 
-def fmtus(us: int) -> str:
-    return f"{us:f}s"
-
-
-def flatten(x: list[list[T]]) -> Iterable[T]:
-    return (item for sublist in x for item in sublist)
-
-
-def asgroups(x: Iterable[T], n: int) -> Iterable[list[T]]:
-    i = 1
-    group: list[T] = []
-    for line in x:
-        group.append(line)
-        if i == n:
-            yield group
-            group = []
-            i = 1
-        else:
-            i += 1
-    if group:
-        yield group
-
-
 ###############################################################################
 
 
@@ -116,23 +85,7 @@ class Integer:
         return self.v - 1
 
 
-@dataclass
-class RedGreenHue:
-    elems: int
-
-    def color(self, idx: int) -> Optional[str]:
-        if self.elems == 0:
-            return None
-        val = int(0xFF * 2 / self.elems * idx)
-        color = "#%02x%02x%02x" % (
-            0xFF - val if 0 <= val < 0xFF else 0x00,
-            val - 0xFF if 0xFF <= val else 0x00,
-            0x00,
-        )
-        return color
-
-
-@dataclass(frozen=True, order=True)
+@dataclass(frozen=True, order=True, **DATACLASS_SLOTS)
 class FunctionKey:
     """To uniquely identify a function."""
 
@@ -144,14 +97,12 @@ class FunctionKey:
         return f"{self.filename}:{self.lineno}({self.funcname})"
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class Record:
     """Single line output from profiling information. Represents one instruction"""
 
     idx: int
     """Instruction number"""
-    stamp_us: int
-    """The timestamp as generated by EPOCHREALTIME"""
     pid: int
     """$BASPID"""
     cmd: str
@@ -171,15 +122,7 @@ class Record:
         return FunctionKey(self.source, self.lineno, self.funcname)
 
 
-class Records(List[Record]):
-    """An array of records"""
-
-    @property
-    def sum_spent_us(self):
-        return sum(x.spent_us for x in self)
-
-
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class CmdStats:
     cmd: str
     callcount: int = 0
@@ -204,16 +147,16 @@ class CallgraphNode:
 
     @cached_property
     def inlinetime(self) -> int:
-        return sum(rr.spent_us for rr in self.records if isinstance(rr, Record))
+        return sum(rr.spent_us for rr in self.records if type(rr) is Record)
 
     @cached_property
     def childtime(self) -> int:
-        return sum(rr.totaltime for rr in self.records if isinstance(rr, CallgraphNode))
+        return sum(rr.totaltime for rr in self.records if type(rr) is CallgraphNode)
 
     @cached_property
     def records_cnt(self) -> int:
         return sum(
-            rr.records_cnt if isinstance(rr, CallgraphNode) else 1
+            rr.records_cnt if type(rr) is CallgraphNode else 1
             for rr in self.records
         )
 
@@ -230,10 +173,28 @@ class CallgraphNode:
     def children(self) -> dict[FunctionKey, "CallgraphNode"]:
         res: dict[FunctionKey, "CallgraphNode"] = {}
         for rr in self.records:
-            if isinstance(rr, CallgraphNode):
+            if type(rr) is CallgraphNode:
                 res[rr.function] = rr
         return res
 
+    def walk(self) -> Iterator[Union[Record, CallgraphNode]]:
+        """Iterate over this node and all records and nodes below it in preorder.
+        Uses an explicit stack, so deep bash call stacks do not hit the recursion limit."""
+        yield self
+        stack: list[Iterator[Union[Record, CallgraphNode]]] = [iter(self.records)]
+        while stack:
+            for rr in stack[-1]:
+                yield rr
+                if type(rr) is CallgraphNode:
+                    stack.append(iter(rr.records))
+                    break
+            else:
+                stack.pop()
+
+    def nodes(self) -> Iterator[CallgraphNode]:
+        """Iterate over this node and all nodes below it in preorder"""
+        return (rr for rr in self.walk() if type(rr) is CallgraphNode)
+
 
 @dataclass
 class AnalyzeArgs:
@@ -299,7 +260,7 @@ class AnalyzeArgs:
     )
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class RecordsSpentInterface:
     records: list[Record] = field(default_factory=list)
     spent: int = 0
@@ -320,7 +281,7 @@ class RecordsSpentInterface:
         return f"{r.source or '~'}:{r.lineno}"
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class FunctionStats(RecordsSpentInterface):
     """Accumulated data about a single function"""
 
@@ -348,7 +309,7 @@ class Timeit:
         print(f"{self.name} took {timedelta(seconds=self.duration)} seconds")
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class CommandStats(RecordsSpentInterface):
     """Accumulated data about a single command"""
 
@@ -356,7 +317,14 @@ class CommandStats(RecordsSpentInterface):
 
     def add(self, rr: Record):
         self.add_record(rr)
-        self.callers.update([rr.funcname])
+        self.callers[rr.funcname] += 1
+
+    def get_example(self):
+        # All records of a command have the same cmd, no need to count them.
+        if not self.records:
+            return "~:0"
+        r = self.records[0]
+        return f"{r.source or '~'}:{r.lineno}"
 
 
 # List of bash scripts used for profiling.
@@ -415,48 +383,54 @@ class LineProcessor:
     Synchronize with profiling bash script.
     """
 
-    def process_line(self, data: list[tuple[int, str]]) -> list[Record]:
-        # data = data if isinstance(data, list) else [data]
+    # printf %q escapes special characters with a backslash, or quotes the whole string as $'...'.
+    # Both forms may contain spaces.
+    QUOTEDLINE = re.compile(
+        r"(\S+) (\S+) (\S+) (\S+) (\S+) (\$'(?:[^'\\]|\\.)*'|(?:[^\s\\]|\\.)+) (\$'(?:[^'\\]|\\.)*'|(?:[^\s\\]|\\.)+) ?(.*)",
+        re.DOTALL,
+    )
+
+    def process_line(self, data: Iterable[tuple[int, str]], stamps: array) -> list[Record]:
+        """The timestamp of each returned record is appended to stamps"""
         ret: list[Record] = []
+        append = ret.append
+        appendstamp = stamps.append
+        # There are few distinct sources and functions, share one string object for each.
+        intern = sys.intern
+        # Commands repeat a lot too, but there can be many of them, so they are shared only within this parse.
+        cmds: dict[str, str] = {}
+        getcmd = cmds.setdefault
         for lineno, line in data:
             line = line.rstrip("\n")
             try:
                 if line.startswith("# "):
-                    # Fix shlex.split not able to parse $'\''
-                    # line = line.replace(r"\'", "")
-                    # arr = shlex.split(line)
-                    arr = line.split(" ", 8)
-                    rr = Record(
-                        idx=lineno,
-                        stamp_us=int(arr[1]),
-                        pid=int(arr[2]),
-                        cmd=" ".join(arr[7:]),
-                        level=int(arr[3]) + 1,
-                        lineno=int(arr[4]),
-                        source=arr[5],
-                        funcname=arr[6],
-                    )
-                    ret.append(rr)
+                    # printf %q escapes a space in source or funcname as a backslash-space
+                    # or quotes the whole field as $'...'. Without either of them,
+                    # splitting 7 times leaves the whole command in arr[7].
+                    arr = line.split(" ", 7)
+                    if arr[5].startswith("$'") or arr[6].startswith("$'") or "\\" in arr[5] or "\\" in arr[6]:
+                        m = self.QUOTEDLINE.fullmatch(line)
+                        if m:
+                            arr = list(m.groups())
+                    cmd = arr[7] if len(arr) > 7 else ""
                 elif line.startswith("+"):
-                    # Fix shlex.split not able to parse $'\''
-                    # line = line.replace(r"\'", "")
-                    # arr = shlex.split(line)
-                    arr = line.split(" ", 8)
-                    rr = Record(
-                        idx=lineno,
-                        stamp_us=int(arr[1]),
-                        pid=int(arr[2]),
-                        cmd=repr(" ".join(arr[7:])),  # arr[6],
-                        level=int(arr[3]) + 1,  # len(arr[0]),
-                        lineno=int(arr[4]),
-                        source=arr[5],
-                        funcname=arr[6],
-                    )
-                    ret.append(rr)
+                    arr = line.split(" ", 7)
+                    cmd = repr(arr[7] if len(arr) > 7 else "")
+                else:
+                    continue
+                rr = Record(
+                    idx=lineno,
+                    pid=int(arr[2]),
+                    cmd=getcmd(cmd, cmd),
+                    level=int(arr[3]) + 1,
+                    lineno=int(arr[4]),
+                    source=intern(arr[5]),
+                    funcname=intern(arr[6]),
+                )
+                # Appending the stamp may fail, append the record only after it, so both stay in step.
+                appendstamp(int(arr[1]))
+                append(rr)
             except Exception:
-                # print("ERROR: lineno:", lineno, " line:", repr(line), e)
-                # raise
-                # break
                 continue
         return ret
 
@@ -465,6 +439,10 @@ class LineProcessor:
 class Analyzer:
     args: AnalyzeArgs
     records: list[Record] = field(default_factory=list)
+    stamps: array = field(default_factory=lambda: array("q"))
+    """The timestamps as generated by EPOCHREALTIME of each record, until spent time is calculated"""
+    functionkeys: dict[tuple[str, int, str], FunctionKey] = field(default_factory=dict)
+    """Interned FunctionKey instances, so that all nodes of the same function share one"""
 
     def run(self):
         with self.timeit(f"Reading {self.args.profilefile}"):
@@ -537,23 +515,10 @@ class Analyzer:
     def read(self):
         # read the data
         with self.args.profilefile as f:
-            # Automatic format detection
-            # Condensed QEMU traces start with # <high_number>
-            # Standard traces start with # <timestamp>
-            peek = f.readline()
-
-            def line_gen():
-                yield peek
-                yield from f
-
+            # Lines are parsed as they are read in this process,
+            # the per-line work is too small to pay off sending it to other processes.
             lp = LineProcessor()
-            with multiprocessing.Pool() as pool:
-                generator = asgroups(
-                    maybe_take_n(enumerate(line_gen()), self.args.linelimit), 100
-                )
-                self.records = sorted(
-                    flatten(pool.map(lp.process_line, generator)), key=lambda x: x.idx
-                )
+            self.records = lp.process_line(maybe_take_n(enumerate(f), self.args.linelimit), self.stamps)
 
             # If the first record has a very large "timestamp" or if qemu flag is set,
             # it's likely instructions. Standard timestamps are > 1e15 (us since epoch).
@@ -564,140 +529,164 @@ class Analyzer:
 
     def calculate_records_spent_time(self):
         # Group records by PID to calculate spent time correctly for concurrent processes
-        by_pid = {}
-        for rr in self.records:
-            by_pid.setdefault(rr.pid, []).append(rr)
-
-        for pid_records in by_pid.values():
-            # Sort by index just in case, although they should already be sorted
-            pid_records.sort(key=lambda x: x.idx)
-            for i in range(len(pid_records) - 1):
-                pid_records[i].spent_us = (
-                    pid_records[i + 1].stamp_us - pid_records[i].stamp_us
-                )
+        # Records are in file order, so are the positions of each PID
+        records = self.records
+        stamps = self.stamps
+        by_pid: defaultdict[int, list[int]] = defaultdict(list)
+        for i, rr in enumerate(records):
+            by_pid[rr.pid].append(i)
+
+        for positions in by_pid.values():
+            for i, nexti in zip(positions, islice(positions, 1, None)):
+                records[i].spent_us = stamps[nexti] - stamps[i]
             # The last record of each PID has unknown spent_us
             # We could set it to 0 or leave it (it defaults to 0 in Record)
-            pid_records[-1].spent_us = 0
+            records[positions[-1]].spent_us = 0
+        # Timestamps are not needed after this
+        self.stamps = array("q")
+
+    def function_key(self, rr: Record) -> FunctionKey:
+        key = (rr.source, rr.lineno, rr.funcname)
+        function = self.functionkeys.get(key)
+        if function is None:
+            function = self.functionkeys[key] = rr.function()
+        return function
+
+    def build_callgraph(self, callgraph: CallgraphNode, records: Iterable[Record], curlevel: int = 1):
+        """Append records of a single PID to the callgraph, opening a node for each function call.
+        curlevel is the level of records that belong directly to the callgraph node."""
+        curnode = callgraph
+        for rr in records:
+            #
+            if rr.level > curlevel:
+                # For new PID, level might start higher than 1 if it's a subshell
+                # But actually BASH_SOURCE depth starts at 1 usually.
+                # If it jumps, we should create intermediate nodes or just handle it.
+                function = self.function_key(rr)
+                for _ in range(rr.level - curlevel):
+                    newnode = CallgraphNode(function, parent=curnode)
+                    curnode.records.append(newnode)
+                    curnode = newnode
+            elif rr.level < curlevel:
+                for i in range(curlevel - rr.level):
+                    if curnode.parent:
+                        curnode = curnode.parent
+            curlevel = rr.level
+            curnode.records.append(rr)
 
     @cached_property
     def get_callgraph(self):
         callgraph = CallgraphNode()
 
-        by_pid = {}
+        by_pid: defaultdict[int, list[Record]] = defaultdict(list)
         for rr in self.records:
-            by_pid.setdefault(rr.pid, []).append(rr)
-
-        for pid, pid_records in by_pid.items():
-            curnode = callgraph
-            curlevel = 1
-            for rr in pid_records:
-                #
-                if rr.level > curlevel:
-                    # For new PID, level might start higher than 1 if it's a subshell
-                    # But actually BASH_SOURCE depth starts at 1 usually.
-                    # If it jumps, we should create intermediate nodes or just handle it.
-                    for _ in range(rr.level - curlevel):
-                        newnode = CallgraphNode(rr.function(), parent=curnode)
-                        curnode.records.append(newnode)
-                        curnode = newnode
-                elif rr.level < curlevel:
-                    for i in range(curlevel - rr.level):
-                        if curnode.parent:
-                            curnode = curnode.parent
-                curlevel = rr.level
-                curnode.records.append(rr)
-
-        if self.args.filterfunction:
+            by_pid[rr.pid].append(rr)
+
+        if not self.args.filterfunction:
+            for pid_records in by_pid.values():
+                self.build_callgraph(callgraph, pid_records)
+        elif re.match(self.args.filterfunction, callgraph.function.funcname):
+            # The root matches, the whole callgraph is the single filtered root.
+            wholegraph = CallgraphNode(parent=callgraph)
+            callgraph.records.append(wholegraph)
+            for pid_records in by_pid.values():
+                self.build_callgraph(wholegraph, pid_records)
+        else:
+            # Build nodes only for the outermost calls of matching functions.
+            # Such a call starts with a record that enters the function
+            # and ends with the first record that returns below its level.
             funcnamergx = re.compile(self.args.filterfunction)
-            callgraph2 = CallgraphNode()
-
-            def traverse_to_filter(node: CallgraphNode):
-                # print("MATCH", node.function.funcname, funcnamergx)
-                if funcnamergx.match(node.function.funcname):
-                    node.parent = callgraph2
-                    callgraph2.records.append(node)
-                else:
-                    for rr in node.records:
-                        if isinstance(rr, CallgraphNode):
-                            # print(f"MATCH @ {rr.function}")
-                            traverse_to_filter(rr)
-
-            traverse_to_filter(callgraph)
-            callgraph = callgraph2
-
+            for pid_records in by_pid.values():
+                curlevel = 1
+                startlevel = 0
+                subtree: list[Record] = []
+                for rr in pid_records:
+                    if startlevel and rr.level < startlevel:
+                        self.build_callgraph(callgraph, subtree, startlevel - 1)
+                        subtree = []
+                        startlevel = 0
+                    if not startlevel and rr.level > curlevel and funcnamergx.match(rr.funcname):
+                        startlevel = curlevel + 1
+                    if startlevel:
+                        subtree.append(rr)
+                    curlevel = rr.level
+                if subtree:
+                    self.build_callgraph(callgraph, subtree, startlevel - 1)
+
+        # Fill the recursive cached properties from the top and from the bottom,
+        # so that deep call stacks do not hit the recursion limit later.
+        nodes = list(callgraph.nodes())
+        for node in nodes:
+            _ = node.level
+        for node in reversed(nodes):
+            _ = node.totaltime
         return callgraph
 
     def dump_records(self, file: str):
         with open(file, "w") as f:
-
-            def traverse(node: CallgraphNode):
-                f.write(f"{'  ' * node.level}{node.function}\n")
-                for rr in node.records:
-                    if isinstance(rr, CallgraphNode):
-                        traverse(rr)
-                    else:
-                        f.write(f"{'  ' * (rr.level + 1)}{rr.cmd}\n")
-
-            traverse(self.get_callgraph)
-
-    @cached_property
-    def commands(self) -> dict[str, CommandStats]:
-        cmds: dict[str, CommandStats] = {}
-
-        def traverse(node: CallgraphNode):
-            for rr in node.records:
-                if isinstance(rr, Record):
-                    if rr.cmd not in cmds:
-                        cmds[rr.cmd] = CommandStats()
-                    cmds[rr.cmd].add(rr)
+            for rr in self.get_callgraph.walk():
+                if type(rr) is Record:
+                    f.write(f"{'  ' * (rr.level + 1)}{rr.cmd}\n")
                 else:
-                    traverse(rr)
-
-        traverse(self.get_callgraph)
-        return cmds
+                    f.write(f"{'  ' * rr.level}{rr.function}\n")
 
     @cached_property
-    def functions(self) -> dict[FunctionKey, FunctionStats]:
+    def stats(self) -> tuple[dict[str, CommandStats], dict[FunctionKey, FunctionStats]]:
+        """Accumulate the commands and functions statistics in a single walk over the callgraph"""
+        cmds: dict[str, CommandStats] = {}
         funcs: dict[FunctionKey, FunctionStats] = {}
+        getcmd = cmds.get
+        # Each record belongs to the records of all function calls it is nested in.
+        callsrecords: list[list[Record]] = []
+        stack: list[tuple[Iterator[Union[Record, CallgraphNode]], bool]] = [(iter(self.get_callgraph.records), False)]
+        while stack:
+            it, iscall = stack[-1]
+            for rr in it:
+                if type(rr) is Record:
+                    stats = getcmd(rr.cmd)
+                    if stats is None:
+                        stats = cmds[rr.cmd] = CommandStats()
+                    stats.add(rr)
+                    for records in callsrecords:
+                        records.append(rr)
+                elif type(rr) is CallgraphNode:
+                    # Skip the root node (empty function name) as it represents the main script, not a real function
+                    childiscall = bool(rr.function.funcname)
+                    if childiscall:
+                        fstats = funcs.get(rr.function)
+                        if fstats is None:
+                            fstats = funcs[rr.function] = FunctionStats()
+                        fstats.calls += 1
+                        fstats.spent += rr.totaltime
+                        fstats.spent_exclusive += rr.inlinetime
+                        callsrecords.append(fstats.records)
+                    stack.append((iter(rr.records), childiscall))
+                    break
+            else:
+                stack.pop()
+                if iscall:
+                    callsrecords.pop()
+        return cmds, funcs
 
-        def traverse(node: CallgraphNode):
-            # Skip the root node (empty function name) as it represents the main script, not a real function
-            if node.function.funcname:
-                if node.function not in funcs:
-                    funcs[node.function] = FunctionStats()
-                funcs[node.function].calls += 1
-                funcs[node.function].spent += node.totaltime
-                funcs[node.function].spent_exclusive += node.inlinetime
-
-                def collect_records(n: CallgraphNode):
-                    for rr in n.records:
-                        if isinstance(rr, Record):
-                            funcs[node.function].records.append(rr)
-                        else:
-                            collect_records(rr)
-
-                collect_records(node)
-
-            for rr in node.records:
-                if isinstance(rr, CallgraphNode):
-                    traverse(rr)
+    @property
+    def commands(self) -> dict[str, CommandStats]:
+        return self.stats[0]
 
-        traverse(self.get_callgraph)
-        return funcs
+    @property
+    def functions(self) -> dict[FunctionKey, FunctionStats]:
+        return self.stats[1]
 
     def print_top_longest_commands(self):
         totaltime = self.get_callgraph.totaltime
         if totaltime == 0:
             return
-        longest_commands = []
-        for cmd, stats in sorted(
-            self.commands.items(), key=lambda x: x[1].spent, reverse=True
-        )[:10]:
-            top_callers = sorted(
-                stats.callers.items(), key=lambda x: x[1], reverse=True
-            )[:3]
-            longest_commands.append(
-                {
+        # Rows are formatted once, even if a command is in both tables.
+        rows: dict[str, dict] = {}
+
+        def row(cmd: str, stats: CommandStats) -> dict:
+            if cmd not in rows:
+                top_callers = stats.callers.most_common(3)
+                rows[cmd] = {
                     "%": color.pct(f"{stats.spent / totaltime * 100:g}"),
                     "us": color.time(stats.spent),
                     "cmd": color.func(dots_trim(cmd, width=40)),
@@ -708,33 +697,26 @@ class Analyzer:
                     "caller3": color.func(getdefault(top_callers, 2, ("", ""))[0]),
                     "location": color.loc(stats.get_example()),
                 }
+            return rows[cmd]
+
+        longest_commands = [
+            row(cmd, stats)
+            for cmd, stats in heapq.nlargest(
+                10, self.commands.items(), key=lambda x: x[1].spent
             )
+        ]
         print(color.style("Top 10 longest commands (total):", bold=True))
         print(tabulate(longest_commands, headers="keys"))
         print()
 
-        longest_commands_per_call = []
-        for cmd, stats in sorted(
-            self.commands.items(),
-            key=lambda x: x[1].spent / len(x[1].records),
-            reverse=True,
-        )[:10]:
-            top_callers = sorted(
-                stats.callers.items(), key=lambda x: x[1], reverse=True
-            )[:3]
-            longest_commands_per_call.append(
-                {
-                    "%": color.pct(f"{stats.spent / totaltime * 100:g}"),
-                    "us": color.time(stats.spent),
-                    "cmd": color.func(dots_trim(cmd, width=40)),
-                    "calls": len(stats.records),
-                    "spent/call": color.time(f"{stats.spent / len(stats.records):g}"),
-                    "caller1": color.func(getdefault(top_callers, 0, ("", ""))[0]),
-                    "caller2": color.func(getdefault(top_callers, 1, ("", ""))[0]),
-                    "caller3": color.func(getdefault(top_callers, 2, ("", ""))[0]),
-                    "location": color.loc(stats.get_example()),
-                }
+        longest_commands_per_call = [
+            row(cmd, stats)
+            for cmd, stats in heapq.nlargest(
+                10,
+                self.commands.items(),
+                key=lambda x: x[1].spent / len(x[1].records),
             )
+        ]
         print(color.style("Top 10 longest commands (per call):", bold=True))
         print(tabulate(longest_commands_per_call, headers="keys"))
         print()
@@ -743,14 +725,12 @@ class Analyzer:
         totaltime = self.get_callgraph.totaltime
         if totaltime == 0:
             return
-        longest_functions = []
-        for func, stats in sorted(
-            self.functions.items(), key=lambda x: x[1].spent, reverse=True
-        )[:10]:
-            if not func.funcname:
-                continue
-            longest_functions.append(
-                {
+        # Rows are formatted once, even if a function is in both tables.
+        rows: dict[FunctionKey, dict] = {}
+
+        def row(func: FunctionKey, stats: FunctionStats) -> dict:
+            if func not in rows:
+                rows[func] = {
                     "%": color.pct(f"{stats.spent / totaltime * 100:g}"),
                     "incl": color.time(stats.spent),
                     "excl": color.time(stats.spent_exclusive),
@@ -759,7 +739,15 @@ class Analyzer:
                     "spent/call": color.time(f"{stats.spent / stats.calls:g}"),
                     "location": color.loc(stats.get_example()),
                 }
+            return rows[func]
+
+        longest_functions = [
+            row(func, stats)
+            for func, stats in heapq.nlargest(
+                10, self.functions.items(), key=lambda x: x[1].spent
             )
+            if func.funcname
+        ]
         if not longest_functions:
             print("No functions found")
             return
@@ -767,25 +755,15 @@ class Analyzer:
         print(tabulate(longest_functions, headers="keys"))
         print()
 
-        longest_functions_per_call = []
-        for func, stats in sorted(
-            self.functions.items(),
-            key=lambda x: x[1].spent / x[1].calls if x[1].calls else 0,
-            reverse=True,
-        )[:10]:
-            if not func.funcname:
-                continue
-            longest_functions_per_call.append(
-                {
-                    "%": color.pct(f"{stats.spent / totaltime * 100:g}"),
-                    "incl": color.time(stats.spent),
-                    "excl": color.time(stats.spent_exclusive),
-                    "func": color.func(dots_trim(str(func), width=40)),
-                    "calls": stats.calls,
-                    "spent/call": color.time(f"{stats.spent / stats.calls:g}"),
-                    "location": color.loc(stats.get_example()),
-                }
+        longest_functions_per_call = [
+            row(func, stats)
+            for func, stats in heapq.nlargest(
+                10,
+                self.functions.items(),
+                key=lambda x: x[1].spent / x[1].calls if x[1].calls else 0,
             )
+            if func.funcname
+        ]
         print(click.style("Top 10 longest functions (per call):", bold=True))
         print(tabulate(longest_functions_per_call, headers="keys"))
         print()
@@ -795,56 +773,75 @@ class Analyzer:
         if root_node.totaltime == 0:
             return
 
-        def render(node: CallgraphNode, parent_total: int, prefix: str = "", is_last: bool = True):
+        print(click.style(f"Call Tree{f' (top {self.args.treelimit} children)' if self.args.treelimit else ''}:", bold=True))
+        if root_node.function.funcname:
+            print(f"{color.func(str(root_node.function))} {color.time(root_node.totaltime)}{'ins' if self.args.qemu else 'us'} {color.pct('100.0%')}")
+
+        # A stack of lines to print and of (node, parent_total, prefix) subtrees to render,
+        # so that deep call stacks do not hit the recursion limit.
+        stack: list[Union[str, tuple[CallgraphNode, int, str]]] = [(root_node, root_node.totaltime, "")]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                print(item)
+                continue
+            node, parent_total, prefix = item
+
             # Aggregate all identical children under this parent
             groups = defaultdict(list)
             for rr in node.records:
-                if isinstance(rr, CallgraphNode):
+                if type(rr) is CallgraphNode:
                     groups[rr.function].append(rr)
 
             # Sort by total time per group
-            aggs = sorted(
-                [(f, sum(c.totaltime for c in g), g) for f, g in groups.items()],
-                key=lambda x: x[1],
-                reverse=True,
-            )
+            aggs = [(f, sum(c.totaltime for c in g), g) for f, g in groups.items()]
             if self.args.treelimit:
-                aggs = aggs[: self.args.treelimit]
+                aggs = heapq.nlargest(self.args.treelimit, aggs, key=lambda x: x[1])
+            else:
+                aggs.sort(key=lambda x: x[1], reverse=True)
 
+            todo: list[Union[str, tuple[CallgraphNode, int, str]]] = []
             for i, (func, total, group) in enumerate(aggs):
                 p = color.pct(f"{total / parent_total * 100:.1f}%") if parent_total > 0 else color.pct("N/A%")
                 unit = "ins" if self.args.qemu else "us"
                 stats = f" ({len(group)} calls, avg {color.time(int(statistics.mean(c.totaltime for c in group)))}{unit}, stddev {color.time(int(statistics.pstdev(c.totaltime for c in group)))}{unit})" if len(group) > 1 else ""
 
                 last = i == len(aggs) - 1
-                print(f"{prefix}{'└── ' if last else '├── '}{color.func(str(func))} {color.time(total)}{unit} {p}{stats}")
+                todo.append(f"{prefix}{'└── ' if last else '├── '}{color.func(str(func))} {color.time(total)}{unit} {p}{stats}")
 
-                # Recurse into the first child as representative for subtree structure
-                # Only recurse if there's meaningful time to show
+                # Descend into the first child as representative for subtree structure
+                # Only descend if there's meaningful time to show
                 if total > 0:
-                    render(group[0], total, prefix + ("    " if last else "│   "), True)
-
-        print(click.style(f"Call Tree{f' (top {self.args.treelimit} children)' if self.args.treelimit else ''}:", bold=True))
-        if root_node.function.funcname:
-            print(f"{color.func(str(root_node.function))} {color.time(root_node.totaltime)}{'ins' if self.args.qemu else 'us'} {color.pct('100.0%')}")
-        render(root_node, root_node.totaltime, "", True)
+                    todo.append((group[0], total, prefix + ("    " if last else "│   ")))
+            stack.extend(reversed(todo))
         print()
 
     def generate_dot_callgraph(self, file: str):
-        dot = Digraph(comment="Bash Callgraph")
-        nodemap = {}
-
-        def traverse(node: CallgraphNode):
-            if node not in nodemap:
-                nodemap[node] = str(len(nodemap))
-                dot.node(nodemap[node], str(node.function))
-            for rr in node.records:
-                if isinstance(rr, CallgraphNode):
-                    traverse(rr)
-                    dot.edge(nodemap[node], nodemap[rr])
-
-        traverse(self.get_callgraph)
-        dot.render(file, view=False)
+        callgraph = self.get_callgraph
+        # CallgraphNode is not hashable, map id() of each node to a short counter name.
+        counter = Integer()
+        nodenames: dict[int, str] = {id(callgraph): f"n{counter.inc()}"}
+        # Write the DOT source directly, graphviz is only needed to render it.
+        with open(file, "w") as f:
+            f.write("// Bash Callgraph\ndigraph {\n")
+            f.write(f"\t{nodenames[id(callgraph)]} [label={dot_quote(str(callgraph.function))}]\n")
+            stack = [callgraph]
+            while stack:
+                node = stack.pop()
+                name = nodenames[id(node)]
+                children = [rr for rr in node.records if type(rr) is CallgraphNode]
+                if self.args.dotlimit:
+                    # Only the longest children are drawn, skip the subtrees of the rest.
+                    children = heapq.nlargest(self.args.dotlimit, children, key=lambda x: x.totaltime)
+                for child in children:
+                    childname = nodenames[id(child)] = f"n{counter.inc()}"
+                    f.write(f"\t{childname} [label={dot_quote(str(child.function))}]\n")
+                    f.write(f"\t{name} -> {childname}\n")
+                stack.extend(reversed(children))
+            f.write("}\n")
+        import graphviz
+
+        graphviz.render("dot", "pdf", file)
 
     def generate_dot_callstats(self, file: str):
         # 1. Sum up all times per function
@@ -898,7 +895,7 @@ class Analyzer:
             # (filename, line, name) -> (cc, nc, tt, ct, callers)
             # callers is dict of (filename, line, name) -> (cc, nc, tt, ct)
             # times are in seconds
-            stats[astuple(func)] = (
+            stats[(func.filename, func.lineno, func.funcname)] = (
                 fstats.calls,
                 fstats.calls,
                 us2s(fstats.spent),
@@ -962,12 +959,9 @@ def _profile(args: ProfileArgs, quiet: bool = False):
         if not args.output or args.output == sys.stdout
         else args.output.name
     )
-    script = "\n".join([args.script] * args.repeat)
-    script = (
-        PROFILEMETHODS[args.method]
-        .replace("%BEFORE%", args.before)
-        .replace("%SCRIPT%", script)
-    )
+    # Substitute the placeholders in a single pass, without copying the whole script for each of them.
+    replacements = {"BEFORE": args.before, "SCRIPT": "\n".join([args.script] * args.repeat)}
+    script = re.sub(r"%(BEFORE|SCRIPT)%", lambda m: replacements[m[1]], PROFILEMETHODS[args.method])
     cmd = [*bash_cmd(), "-c", script, "bash", profilefile, *args.args]
     if args.method in ["4", "QEMU"]:
         # Create FIFO in temporary directory (like compare command does)
@@ -1218,28 +1212,70 @@ def analyze(args: AnalyzeArgs):
 
 @cli.command(help="print pstats data")
 @click.option("-r", "--raw", is_flag=True, help="Just print marshal file content")
+@click.option(
+    "-n",
+    "--limit",
+    type=click.IntRange(min=1),
+    help="Print only that many entries with the highest cumulative time. With --raw or --json, also only that many callers of each.",
+)
+@click.option(
+    "-j", "--json", "json_", is_flag=True, help="Print marshal file content as JSON to stdout."
+)
 @click.argument("file", type=click.File("rb", lazy=True))
 @click_help()
-def showpstats(raw: bool, file: io.FileIO):
-    if raw:
+def showpstats(raw: bool, limit: Optional[int], json_: bool, file: io.FileIO):
+    if raw or json_:
 
         def sortthem(x: dict):
+            if limit:
+                return maybe_take_n(
+                    sorted(x.items(), key=lambda kv: kv[1][3], reverse=True), limit
+                )
             return sorted(x.items())
 
-        def printit(prefix, key, val):
-            print(
-                f"{prefix}{key[0]}:{key[1]}({key[2]})  cc={val[0]} nc={val[1]} tt={val[2]:f} ct={val[3]:f}"
-            )
+        def formatit(prefix, key, val):
+            return f"{prefix}{key[0]}:{key[1]}({key[2]})  cc={val[0]} nc={val[1]} tt={val[2]:f} ct={val[3]:f}\n"
+
+        def jsonit(key, val):
+            return {
+                "filename": key[0],
+                "lineno": key[1],
+                "funcname": key[2],
+                "cc": val[0],
+                "nc": val[1],
+                "tt": val[2],
+                "ct": val[3],
+            }
 
         stats = marshal.load(file)
-        for key, val in sortthem(stats):
-            printit("", key, val)
-            for key2, val2 in sortthem(val[4] or {}):
-                printit(" ^ ", key2, val2)
+        if json_:
+            import json
+
+            data = [
+                {
+                    **jsonit(key, val),
+                    "callers": [jsonit(key2, val2) for key2, val2 in sortthem(val[4])]
+                    if val[4]
+                    else [],
+                }
+                for key, val in sortthem(stats)
+            ]
+            print(json.dumps(data, indent=2))
+            return
+
+        def generatelines():
+            for key, val in sortthem(stats):
+                yield formatit("", key, val)
+                callers = val[4]
+                if callers:
+                    for key2, val2 in sortthem(callers):
+                        yield formatit(" ^ ", key2, val2)
+
+        sys.stdout.writelines(generatelines())
     else:
         ps = pstats.Stats(file.name)
         sortby = "cumulative"
-        ps.strip_dirs().sort_stats(sortby).print_stats()
+        ps.strip_dirs().sort_stats(sortby).print_stats(*([limit] if limit else []))
 
 
 ###############################################################################
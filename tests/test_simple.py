@@ -35,6 +35,11 @@ def test_1():
             run("L_bash_profile showpstats --raw %s", dotf)
 
 
+def test_deep_recursion():
+    # Call stack deeper than Python's recursion limit
+    run("L_bash_profile run 'f() { (($1)) && f $(($1-1)); }; f 1200'")
+
+
 def test_qemu():
     if not is_qemu_available():
         pytest.skip("QEMU not available")
@@ -113,6 +118,164 @@ def test_json_output():
     assert "Insn" in data_compare[0]
 
 
+def test_showpstats_json():
+    import json
+    with tempfile.NamedTemporaryFile(prefix="L_bash_profile_test_", suffix=".txt") as f:
+        tmpf = f.name
+        run("L_bash_profile profile --output %s 'f() { :; }; f'", tmpf)
+        with tempfile.NamedTemporaryFile(prefix="L_bash_profile_test_", suffix=".pstats") as f2:
+            run("L_bash_profile analyze --pstats %s %s", f2.name, tmpf)
+            cmd = ["L_bash_profile", "showpstats", "--json", f2.name]
+            proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            data = json.loads(proc.stdout)
+            assert any(x["funcname"] == "f" for x in data)
+            assert all("callers" in x for x in data)
+
+
+def test_showpstats_limit():
+    with tempfile.NamedTemporaryFile(prefix="L_bash_profile_test_", suffix=".txt") as f:
+        tmpf = f.name
+        run("L_bash_profile profile --output %s 'f() { :; }; g() { :; }; f; g'", tmpf)
+        with tempfile.NamedTemporaryFile(prefix="L_bash_profile_test_", suffix=".pstats") as f2:
+            run("L_bash_profile analyze --pstats %s %s", f2.name, tmpf)
+            cmd = ["L_bash_profile", "showpstats", "--raw", f2.name]
+            proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            assert len(proc.stdout.splitlines()) == 2
+            cmd = ["L_bash_profile", "showpstats", "--raw", "-n", "1", f2.name]
+            proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            assert len(proc.stdout.splitlines()) == 1
+            run("L_bash_profile showpstats -n 1 %s", f2.name)
+            for limit in ["0", "-2"]:
+                cmd = ["L_bash_profile", "showpstats", "--raw", "-n", limit, f2.name]
+                assert subprocess.run(cmd, capture_output=True).returncode != 0
+
+
+def test_quoted_source():
+    import json
+    import os
+    with tempfile.TemporaryDirectory() as tmpd:
+        # printf %q quotes this path as $'...' with a space inside
+        script = os.path.join(tmpd, "a b\nc.sh")
+        with open(script, "w") as f:
+            f.write("g() { :; }\ng\n")
+        cmd = ["L_bash_profile", "run", "--json", f". {shlex.quote(script)}"]
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        data = json.loads(proc.stdout)
+        g = next(f for f in data["functions"] if f["funcname"] == "g")
+        assert g["filename"] == "$'" + tmpd + "/a b\\nc.sh'"
+
+
+def test_backslash_quoted_source():
+    import json
+    import os
+    with tempfile.TemporaryDirectory() as tmpd:
+        # printf %q quotes this path with a backslash before the space
+        script = os.path.join(tmpd, "a b.sh")
+        with open(script, "w") as f:
+            f.write("g() { :; }\ng\n")
+        cmd = ["L_bash_profile", "run", "--json", f". {shlex.quote(script)}"]
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        data = json.loads(proc.stdout)
+        g = next(f for f in data["functions"] if f["funcname"] == "g")
+        assert g["filename"] == tmpd + "/a\\ b.sh"
+
+
+def test_malformed_line():
+    import json
+    with tempfile.NamedTemporaryFile("w", prefix="L_bash_profile_test_", suffix=".txt") as f:
+        # The middle line has a timestamp that does not fit into 64 bits and is skipped
+        f.write("# 1000 1 0 1 a b x\n# 99999999999999999999 1 0 1 a b y\n# 2000 1 0 1 a b z\n")
+        f.flush()
+        cmd = ["L_bash_profile", "analyze", "--json", f.name]
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        data = json.loads(proc.stdout)
+        assert data["total_time"] == 1000
+        assert {x["cmd"]: x["spent"] for x in data["commands"]} == {"x": 1000, "z": 0}
+
+
+# g calls f twice, then f is called from top level
+CALLGRAPH_TRACE = [
+    "# 1 1 0 1 s > g",
+    "# 2 1 1 2 s g f",
+    "# 3 1 2 3 s f x",
+    "# 4 1 1 4 s g f",
+    "# 5 1 2 3 s f y",
+    "# 6 1 0 5 s > f",
+    "# 7 1 1 3 s f z",
+    "# 8 1 0 6 s > END",
+]
+
+
+def write_callgraph_trace(tmpd: str) -> str:
+    tracef = f"{tmpd}/trace.txt"
+    with open(tracef, "w") as f:
+        f.write("".join(x + "\n" for x in CALLGRAPH_TRACE))
+    return tracef
+
+
+def test_filterfunction():
+    expected = {
+        # Calls of f nested in g and called from top level
+        "f": [
+            ":-1()",
+            "  s:3(f)",
+            "        x",
+            "  s:3(f)",
+            "        y",
+            "  s:3(f)",
+            "      z",
+        ],
+        # The root matches, so the whole callgraph is kept
+        ".*": [
+            ":-1()",
+            "  :-1()",
+            "    g",
+            "    s:2(g)",
+            "      f",
+            "      s:3(f)",
+            "        x",
+            "      f",
+            "      s:3(f)",
+            "        y",
+            "    f",
+            "    s:3(f)",
+            "      z",
+            "    END",
+        ],
+    }
+    with tempfile.TemporaryDirectory() as tmpd:
+        tracef = write_callgraph_trace(tmpd)
+        for funcname, tree in expected.items():
+            recordsf = f"{tmpd}/records.txt"
+            run("L_bash_profile analyze --filterfunction %s --dumprecords %s %s", funcname, recordsf, tracef)
+            with open(recordsf) as f:
+                assert f.read().splitlines() == tree
+
+
+def test_callgraph():
+    if shutil.which("dot") is None:
+        pytest.skip("graphviz dot not available")
+    with tempfile.TemporaryDirectory() as tmpd:
+        tracef = write_callgraph_trace(tmpd)
+        dotf = f"{tmpd}/callgraph.dot"
+        run("L_bash_profile analyze --callgraph %s %s", dotf, tracef)
+        with open(dotf) as f:
+            lines = f.read().splitlines()
+        assert lines[:2] == ["// Bash Callgraph", "digraph {"]
+        assert '\tn1 [label="s:2(g)"]' in lines
+        assert sorted(x for x in lines if "->" in x) == [
+            "\tn0 -> n1",
+            "\tn0 -> n2",
+            "\tn1 -> n3",
+            "\tn1 -> n4",
+        ]
+        # Only the longest child of each node is drawn
+        run("L_bash_profile analyze --dotlimit 1 --callgraph %s %s", dotf, tracef)
+        with open(dotf) as f:
+            lines = f.read().splitlines()
+        assert sorted(x for x in lines if "->" in x) == ["\tn0 -> n1", "\tn1 -> n2"]
+
+
 def test_compare_exit_codes():
     import json
     cmd = shlex.split("L_bash_profile compare --json 'exit 0' 'exit 42'")